@@ -0,0 +1,105 @@
+import time
+from collections import Counter, OrderedDict
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class AdmissionController:
+    """
+    Per-user and per-chat token buckets plus a global cap on in-flight LLM work.
+    Runs on the event loop only, so no locking. Rejections are counted by reason.
+    """
+
+    MAX_BUCKETS = 10000  # least recently used buckets are dropped past this
+
+    def __init__(self, user_rate, user_burst, chat_rate, chat_burst, max_in_flight):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.admitted = 0
+        self.throttled = Counter()
+        self._user_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._notified: OrderedDict[int, float] = OrderedDict()
+
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+            if len(buckets) > self.MAX_BUCKETS:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def acquire(self, user_id, chat_id):
+        """
+        Try to admit one unit of LLM work. Returns None when admitted (the caller
+        must call release()), otherwise the reason: "global", "user" or "chat".
+        Tokens are only spent when every check passes.
+        """
+        now = time.monotonic()
+        if self.in_flight >= self.max_in_flight:
+            reason = "global"
+        else:
+            user = self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst)
+            chat = self._bucket(self._chat_buckets, chat_id, self.chat_rate, self.chat_burst)
+            if not user.available(now):
+                reason = "user"
+            elif not chat.available(now):
+                reason = "chat"
+            else:
+                user.take()
+                chat.take()
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+        self.throttled[reason] += 1
+        return reason
+
+    def should_notify(self, user_id):
+        """
+        True at most once per user per refill window (the time to earn one token),
+        so a flooding user gets one notice rather than one per dropped message.
+        """
+        now = time.monotonic()
+        window = 1 / self.user_rate if self.user_rate > 0 else float("inf")
+        last = self._notified.get(user_id)
+        if last is not None and now - last < window:
+            return False
+        self._notified[user_id] = now
+        self._notified.move_to_end(user_id)
+        if len(self._notified) > self.MAX_BUCKETS:
+            self._notified.popitem(last=False)
+        return True
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "admitted": self.admitted,
+            "throttled": dict(self.throttled),
+        }
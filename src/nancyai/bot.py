@@ -1,3 +1,5 @@
+import hmac
+import json
 import asyncio
 import logging
 import sys
@@ -16,12 +18,24 @@ from aiogram.enums import ParseMode, ChatType
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
     Message,
+    Update,
 )
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 
+from .admission import AdmissionController
 from .chatbot import get_ai_generator
-from .movie import MovieExtractor
+from .deadline import Deadline
+from .dedup import get_dedup_cache, update_keys
+from .profiling import (
+    install_slow_callback_monitor,
+    recent_traces,
+    sample_stacks,
+    slowest_callbacks,
+    span,
+    trace,
+)
+from .movie import MovieExtractor, rule_metadata
 
 TOKEN = getenv("BOT_TOKEN")
 if not TOKEN:
@@ -37,12 +51,32 @@ if WEBHOOK_HOST and WEBHOOK_HOST.endswith('/'):
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
 WEBHOOK_REMOVABLE = getenv("WEBHOOK_REMOVABLE", "false").lower() in ("1", "true", "yes", "y")
+MEDIA_DEADLINE_SECONDS = float(getenv("MEDIA_DEADLINE_SECONDS", "5"))
+DEADLINE_GRACE_SECONDS = 0.5  # slack for executor scheduling before the handler stops waiting
+DEDUP_DB_PATH = getenv("DEDUP_DB_PATH", "")
+DEDUP_TTL_SECONDS = float(getenv("DEDUP_TTL_SECONDS", "600"))
+DEDUP_MAX_ENTRIES = int(getenv("DEDUP_MAX_ENTRIES", "10000"))
+DEBUG_TOKEN = getenv("DEBUG_TOKEN", "")
+USER_RATE_PER_MINUTE = float(getenv("USER_RATE_PER_MINUTE", "10"))
+USER_BURST = int(getenv("USER_BURST", "5"))
+CHAT_RATE_PER_MINUTE = float(getenv("CHAT_RATE_PER_MINUTE", "30"))
+CHAT_BURST = int(getenv("CHAT_BURST", "10"))
+LLM_MAX_IN_FLIGHT = int(getenv("LLM_MAX_IN_FLIGHT", "8"))
+THROTTLED_REPLY = "Slow down a little 🦋 Nancy skipped your last message because too many are arriving. Please send it again in a few seconds."
 
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
 _ai = None
 _movie_extractor = None
+_dedup_cache = get_dedup_cache(DEDUP_DB_PATH, ttl=DEDUP_TTL_SECONDS, max_entries=DEDUP_MAX_ENTRIES)
+_admission = AdmissionController(
+    user_rate=USER_RATE_PER_MINUTE / 60,
+    user_burst=USER_BURST,
+    chat_rate=CHAT_RATE_PER_MINUTE / 60,
+    chat_burst=CHAT_BURST,
+    max_in_flight=LLM_MAX_IN_FLIGHT,
+)
 
 BOT_USERNAME = None
 PENDING_LINK_MEDIA = {}
@@ -76,6 +110,50 @@ def movie_extractor():
     return _movie_extractor
 
 
+def _sender_id(message: Message):
+    # Channel posts and anonymous admins have no from_user; bucket them per chat.
+    return message.from_user.id if message.from_user else message.chat.id
+
+
+def _release_when_done(futures):
+    """
+    Give the admission slot back once every executor future has really finished.
+    The handler may stop waiting at the deadline while a worker thread is still
+    talking to Groq/OMDb; that call still counts as in-flight LLM work.
+    """
+    pending = len(futures)
+
+    def done(future):
+        nonlocal pending
+        if not future.cancelled():
+            future.exception()  # already surfaced (or abandoned) by _await_stage
+        pending -= 1
+        if pending == 0:
+            _admission.release()
+
+    if not futures:
+        _admission.release()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+async def _await_stage(deadline, future, name):
+    """
+    Wait for an executor stage until the deadline (plus grace) runs out.
+    The stage budgets itself; this only guards against one that overruns.
+    The future is shielded so the worker keeps its done callbacks. Returns None on overrun.
+    """
+    try:
+        with span(name):
+            return await asyncio.wait_for(
+                asyncio.shield(future),
+                timeout=deadline.remaining() + DEADLINE_GRACE_SECONDS
+            )
+    except asyncio.TimeoutError:
+        logging.warning("%s overran the media deadline; degrading.", name)
+        return None
+
+
 def _format_duration(runtime_str):
     if not runtime_str or "min" not in runtime_str:
         return None
@@ -187,6 +265,21 @@ def _format_metadata_details(meta, heading='Filename + Caption Metadata ↓'):
     return "\n".join(lines)
 
 
+@dp.update.outer_middleware()
+async def dedup_middleware(handler, event: Update, data):
+    # Telegram redelivers the webhook when we answer slowly; drop repeats before any work.
+    if _dedup_cache.check_and_mark(*update_keys(event)):
+        logging.info("Skipping duplicate update %s.", event.update_id)
+        return None
+    return await handler(event, data)
+
+
+@dp.update.outer_middleware()
+async def trace_middleware(handler, event: Update, data):
+    with trace("update", update_id=event.update_id, type=event.event_type):
+        return await handler(event, data)
+
+
 @dp.message(CommandStart())
 async def command_start_handler(message: Message):
     await message.answer(f"Hello, {html.bold(message.from_user.full_name)}! Send media or text.")
@@ -266,50 +359,52 @@ async def message_handler(message: Message):
 
         extractor = movie_extractor()
         details = None
+        raw_meta = None
+        combo_text = f"{filename or ''} {original_caption}".strip()
         if extractor:
-            try:
+            throttled = _admission.acquire(_sender_id(message), message.chat.id)
+            if throttled:
+                logging.info("Media throttled (%s limit); using rule-only caption.", throttled)
+                raw_meta = rule_metadata(combo_text)
+            else:
+                # Primary lookup and metadata extraction are independent, so both run
+                # against the same per-message deadline instead of one after the other.
+                deadline = Deadline(MEDIA_DEADLINE_SECONDS)
                 loop = asyncio.get_running_loop()
-                details = await loop.run_in_executor(
-                    None,
-                    extractor.process,
-                    filename,
-                    original_caption
+                stages = [("process", loop.run_in_executor(None, extractor.process, filename, original_caption, deadline))]
+                if combo_text:
+                    stages.append((
+                        "extract_movie_metadata",
+                        loop.run_in_executor(None, extractor.extract_movie_metadata, combo_text, deadline)
+                    ))
+                _release_when_done([future for _, future in stages])
+                results = await asyncio.gather(
+                    *(_await_stage(deadline, future, name) for name, future in stages),
+                    return_exceptions=True,
                 )
-                logging.debug("Movie details (primary)=%s", details)
-            except Exception:
-                logging.exception("Movie extraction failed (primary)")
+                primary = results[0]
+                secondary = results[1] if len(results) > 1 else None
+                if isinstance(primary, BaseException):
+                    logging.error("Movie extraction failed (primary)", exc_info=primary)
+                else:
+                    details = primary
+                    logging.debug("Movie details (primary)=%s", details)
+                if isinstance(secondary, BaseException):
+                    logging.error("Metadata extraction failed (secondary)", exc_info=secondary)
+                else:
+                    raw_meta = secondary
 
         formatted = _format_movie_details(details)
         if formatted:
             new_caption = formatted
 
-            # Secondary metadata extraction using extract_movie_metadata on filename + caption
-            metadata_formatted = None
-            if extractor:
-                try:
-                    combo_text = f"{filename or ''} {original_caption}".strip()
-                    if combo_text:
-                        loop = asyncio.get_running_loop()
-                        raw_meta = await loop.run_in_executor(
-                            None,
-                            extractor.extract_movie_metadata,
-                            combo_text
-                        )
-
-                        # If primary runtime available, override Duration
-                        if raw_meta and details and details.get("Runtime"):
-                            runtime_human = _format_duration(details.get("Runtime"))
-                            if runtime_human:
-                                raw_meta["Duration"] = runtime_human
-
-                        metadata_formatted = _format_metadata_details(
-                            raw_meta,
-                            heading='Metadata:'
-                        )
-                except Exception:
-                    logging.exception("Metadata extraction failed (secondary)")
-                    metadata_formatted = None
+            # If primary runtime available, override Duration
+            if raw_meta and details and details.get("Runtime"):
+                runtime_human = _format_duration(details.get("Runtime"))
+                if runtime_human:
+                    raw_meta["Duration"] = runtime_human
 
+            metadata_formatted = _format_metadata_details(raw_meta, heading='Metadata:')
             if metadata_formatted:
                 new_caption += f"\n\n{metadata_formatted}"
             else:
@@ -317,26 +412,8 @@ async def message_handler(message: Message):
                 if original_caption.strip():
                     new_caption += f"\n\n<b>Original Caption ↓</b>\n💬 {html.quote(original_caption.strip())}"
         else:
-            # No primary movie details; still try metadata before final fallback
-            extractor = movie_extractor()
-            metadata_formatted = None
-            if extractor:
-                try:
-                    combo_text = f"{filename or ''} {original_caption}".strip()
-                    if combo_text:
-                        loop = asyncio.get_running_loop()
-                        raw_meta = await loop.run_in_executor(
-                            None,
-                            extractor.extract_movie_metadata,
-                            combo_text
-                        )
-                        metadata_formatted = _format_metadata_details(
-                            raw_meta,
-                            heading='Metadata:'
-                        )
-                except Exception:
-                    logging.exception("Metadata extraction failed (only pass)")
-
+            # No primary movie details; fall back to metadata, then the original caption
+            metadata_formatted = _format_metadata_details(raw_meta, heading='Metadata:')
             if metadata_formatted:
                 new_caption = metadata_formatted
             else:
@@ -365,13 +442,14 @@ async def message_handler(message: Message):
             new_caption = new_caption[:1017] + "..."
 
         try:
-            copied = await message.bot.copy_message(
-                chat_id=message.chat.id,
-                from_chat_id=message.chat.id,
-                message_id=message.message_id,
-                caption=new_caption,
-                reply_markup=None
-            )
+            with span("copy_message"):
+                copied = await message.bot.copy_message(
+                    chat_id=message.chat.id,
+                    from_chat_id=message.chat.id,
+                    message_id=message.message_id,
+                    caption=new_caption,
+                    reply_markup=None
+                )
             MOVIE_META[copied.message_id] = {
                 "details": details,
                 "original_caption": original_caption,
@@ -398,13 +476,14 @@ async def message_handler(message: Message):
                 else:
                     log_caption = None
 
-                await message.bot.copy_message(
-                    chat_id=dest,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id,
-                    caption=log_caption,
-                    reply_markup=None
-                )
+                with span("log_channel_copy"):
+                    await message.bot.copy_message(
+                        chat_id=dest,
+                        from_chat_id=message.chat.id,
+                        message_id=message.message_id,
+                        caption=log_caption,
+                        reply_markup=None
+                    )
                 logging.info("Media also copied to log channel.")
             else:
                 logging.debug("LOG_CHANNEL_ID not set; skipping log copy.")
@@ -412,7 +491,8 @@ async def message_handler(message: Message):
             logging.exception("Failed to copy media to log channel")
 
         try:
-            await message.delete()
+            with span("delete_original"):
+                await message.delete()
         except Exception as e:
             logging.debug("Delete original failed: %s", e)
         return
@@ -429,13 +509,24 @@ async def message_handler(message: Message):
         await message.reply("AI not ready.")
         return
 
+    throttled = _admission.acquire(_sender_id(message), message.chat.id)
+    if throttled:
+        logging.info("Chat throttled (%s limit) for user %s.", throttled, _sender_id(message))
+        if _admission.should_notify(_sender_id(message)):
+            await message.reply(THROTTLED_REPLY)
+        return
+
     try:
         user_name = message.from_user.full_name or message.from_user.first_name or ""
-        reply = await generator.generate_reply(message.from_user.id, user_name, txt)
-        await message.reply(reply)
+        with span("generate_reply"):
+            reply = await generator.generate_reply(message.from_user.id, user_name, txt)
+        with span("send_reply"):
+            await message.reply(reply)
     except Exception:
         logging.exception("AI generation failed")
         await message.reply("Error generating reply.")
+    finally:
+        _admission.release()
 
 # --- Webhook Setup ---
 async def on_startup(app: web.Application):
@@ -459,6 +550,7 @@ async def on_shutdown(app: web.Application):
     if WEBHOOK_REMOVABLE:
         logging.info("Deleting webhook")
         await bot.delete_webhook()
+    _dedup_cache.close()
 
 # added: serve log file at "/"
 async def view_log(request: web.Request):
@@ -488,6 +580,66 @@ async def view_log(request: web.Request):
             charset="utf-8",
         )
 
+# --- Admin debug endpoints (disabled unless DEBUG_TOKEN is set) ---
+def _is_admin(request: web.Request):
+    if not DEBUG_TOKEN:
+        return False
+    # Header only: query strings end up in the access log, which "/" serves publicly.
+    supplied = request.headers.get("X-Debug-Token", "")
+    return hmac.compare_digest(supplied.encode(), DEBUG_TOKEN.encode())
+
+
+def _int_query(request: web.Request, name, default):
+    try:
+        return max(1, int(request.query.get(name, default)))
+    except ValueError:
+        return default
+
+
+def _json_response(payload):
+    return web.Response(
+        text=json.dumps(payload, indent=2, default=str),
+        content_type="application/json",
+        charset="utf-8",
+    )
+
+
+async def debug_profile(request: web.Request):
+    """Sample all threads for ?seconds=N and return collapsed stacks for a flamegraph."""
+    if not _is_admin(request):
+        return web.Response(text="Forbidden.", status=403, content_type="text/plain", charset="utf-8")
+    seconds = _int_query(request, "seconds", 10)
+    try:
+        loop = asyncio.get_running_loop()
+        collapsed = await loop.run_in_executor(None, sample_stacks, seconds)
+    except RuntimeError as e:
+        return web.Response(text=str(e), status=409, content_type="text/plain", charset="utf-8")
+    return web.Response(
+        text=collapsed,
+        content_type="text/plain",
+        charset="utf-8",
+        headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'},
+    )
+
+
+async def debug_slow_callbacks(request: web.Request):
+    if not _is_admin(request):
+        return web.Response(text="Forbidden.", status=403, content_type="text/plain", charset="utf-8")
+    return _json_response(slowest_callbacks(_int_query(request, "limit", 20)))
+
+
+async def debug_traces(request: web.Request):
+    if not _is_admin(request):
+        return web.Response(text="Forbidden.", status=403, content_type="text/plain", charset="utf-8")
+    return _json_response(recent_traces(_int_query(request, "limit", 50)))
+
+
+async def debug_admission(request: web.Request):
+    if not _is_admin(request):
+        return web.Response(text="Forbidden.", status=403, content_type="text/plain", charset="utf-8")
+    return _json_response(_admission.stats())
+
+
 def main():
 
     # Setup logging
@@ -521,6 +673,14 @@ def main():
     # added: root path shows the log
     app.router.add_get("/", view_log)
 
+    # Admin-only diagnostics
+    app.router.add_get("/debug/profile", debug_profile)
+    app.router.add_get("/debug/slow-callbacks", debug_slow_callbacks)
+    app.router.add_get("/debug/traces", debug_traces)
+    app.router.add_get("/debug/admission", debug_admission)
+    if DEBUG_TOKEN:
+        install_slow_callback_monitor()
+
     # Setup startup and shutdown
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
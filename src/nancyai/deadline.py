@@ -0,0 +1,70 @@
+import time
+import logging
+import threading
+
+
+class Deadline:
+    """Wall-clock budget shared by every stage that works on one message."""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def share(self, fraction):
+        """Return `fraction` of the remaining budget, in seconds."""
+        return self.remaining() * fraction
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream after `failure_threshold` consecutive failures.
+    Once `reset_timeout` seconds have passed a single trial call is let through;
+    success closes the breaker again, failure re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_flight:
+                return False
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """End a call that said nothing about upstream health (e.g. cut short by our own deadline)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Circuit %s closed.", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logging.warning("Circuit %s opened after %s failures.", self.name, self._failures)
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
@@ -0,0 +1,127 @@
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class UpdateDedupCache:
+    """Bounded in-memory set of recently seen keys with TTL eviction."""
+
+    def __init__(self, ttl=600.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def check_and_mark(self, *keys):
+        """Return True if any of `keys` was already seen within the TTL; record the unseen ones."""
+        now = time.monotonic()
+        duplicate = False
+        with self._lock:
+            self._evict(now)
+            for key in keys:
+                if key in self._seen:
+                    duplicate = True
+                    continue
+                self._seen[key] = now
+                if len(self._seen) > self.max_entries:
+                    self._seen.popitem(last=False)
+            return duplicate
+
+    def close(self):
+        pass
+
+
+class SQLiteDedupCache:
+    """Same contract as UpdateDedupCache, persisted so it survives restarts."""
+
+    PRUNE_EVERY = 100  # inserts between TTL / size pruning passes
+
+    def __init__(self, path, ttl=600.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Runs on the event loop: in WAL mode NORMAL skips the per-commit fsync.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_updates (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS seen_updates_seen_at ON seen_updates (seen_at)")
+        self._prune(time.time())
+        self._conn.commit()
+
+    def _prune(self, now):
+        self._conn.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM seen_updates WHERE key NOT IN "
+            "(SELECT key FROM seen_updates ORDER BY seen_at DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def check_and_mark(self, *keys):
+        # Wall clock, not monotonic: entries must stay comparable across restarts.
+        now = time.time()
+        duplicate = False
+        with self._lock:
+            if self._conn is None:
+                # Closed during shutdown while updates were still in flight; let them through.
+                return False
+            try:
+                for key in keys:
+                    self._conn.execute(
+                        "DELETE FROM seen_updates WHERE key = ? AND seen_at < ?", (key, now - self.ttl)
+                    )
+                    cur = self._conn.execute(
+                        "INSERT OR IGNORE INTO seen_updates (key, seen_at) VALUES (?, ?)", (key, now)
+                    )
+                    if cur.rowcount == 0:
+                        duplicate = True
+                    else:
+                        self._inserts += 1
+                        if self._inserts % self.PRUNE_EVERY == 0:
+                            self._prune(now)
+                self._conn.commit()
+            except sqlite3.Error:
+                # Locked or full database: processing twice beats dropping the update.
+                logging.exception("Dedup cache check failed; letting update through.")
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    pass
+                return False
+            return duplicate
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def get_dedup_cache(path=None, ttl=600.0, max_entries=10000):
+    if path:
+        try:
+            return SQLiteDedupCache(path, ttl=ttl, max_entries=max_entries)
+        except Exception:
+            logging.exception("SQLite dedup cache at %s unavailable; using in-memory cache.", path)
+    return UpdateDedupCache(ttl=ttl, max_entries=max_entries)
+
+
+def update_keys(update):
+    """Keys identifying an update: its update_id, plus (chat_id, message_id) for new messages."""
+    keys = [f"u:{update.update_id}"]
+    message = update.message
+    if message is not None and message.chat is not None:
+        keys.append(f"m:{message.chat.id}:{message.message_id}")
+    return keys
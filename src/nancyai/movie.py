@@ -4,11 +4,28 @@ import logging
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from groq import Groq
+from groq import Groq, APITimeoutError
+
+from .deadline import CircuitBreaker
+
+METADATA_KEYS = ["Size", "Duration", "Audio", "Quality", "HD", "Subtitles", "Video", "AudioDetails"]
+MIN_STAGE_SECONDS = 0.25  # below this a stage is skipped rather than started
+LLM_EXTRACT_SHARE = 0.6  # part of the remaining budget process() gives the LLM, OMDb gets the rest
+GROQ_TIMEOUT = 20.0
+OMDB_TIMEOUT = 8
+MIN_FAILURE_TIMEOUT = 1.0  # timeouts on a budget shorter than this are ours, not the upstream's
+
+
+def _is_upstream_failure(error, timeout):
+    """A timeout counts against the upstream unless the stage was starved of budget."""
+    if isinstance(error, (APITimeoutError, requests.Timeout)):
+        return timeout >= MIN_FAILURE_TIMEOUT
+    return True
+
 
 class MovieExtractor:
     def __init__(self, groq_api_key, omdb_api_key, model="llama-3.3-70b-versatile"):
-        self.groq_client = Groq(api_key=groq_api_key, timeout=20.0)
+        self.groq_client = Groq(api_key=groq_api_key, timeout=GROQ_TIMEOUT)
         self.omdb_api_key = omdb_api_key
         self.model = model
         self.session = requests.Session()
@@ -20,21 +37,63 @@ class MovieExtractor:
         )
         self.session.mount("https://", HTTPAdapter(max_retries=retry))
         self.session.headers.update({"User-Agent": "nancyai/2.1"})
+        # Deadline-bound lookups get a single attempt; retries would overrun the budget.
+        self.single_shot_session = requests.Session()
+        self.single_shot_session.mount("https://", HTTPAdapter(max_retries=0))
+        self.single_shot_session.headers.update({"User-Agent": "nancyai/2.1"})
+        self.groq_breaker = CircuitBreaker("groq")
+        self.omdb_breaker = CircuitBreaker("omdb")
+
+    def _stage_timeout(self, deadline, fraction=1.0, normal_timeout=GROQ_TIMEOUT):
+        """Seconds a stage may use, or None when the deadline leaves too little to bother."""
+        if deadline is None:
+            return normal_timeout
+        timeout = min(deadline.share(fraction), normal_timeout)
+        if timeout < MIN_STAGE_SECONDS:
+            return None
+        return timeout
 
-    def _llm_extract(self, text):
+    def _complete(self, prompt, deadline=None, fraction=1.0):
+        """Run a Groq completion within the deadline; None if skipped."""
+        timeout = self._stage_timeout(deadline, fraction)
+        if timeout is None:
+            logging.warning("Deadline exhausted; skipping Groq completion.")
+            return None
+        if not self.groq_breaker.allow():
+            logging.warning("Groq circuit open; skipping completion.")
+            return None
+        client = self.groq_client
+        if deadline is not None:
+            client = client.with_options(timeout=timeout, max_retries=0)
+        recorded = False
+        try:
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0
+            )
+            self.groq_breaker.record_success()
+            recorded = True
+        except Exception as e:
+            if _is_upstream_failure(e, timeout):
+                self.groq_breaker.record_failure()
+                recorded = True
+            raise
+        finally:
+            if not recorded:
+                self.groq_breaker.release()
+        return response.choices[0].message.content
+
+    def _llm_extract(self, text, deadline=None, fraction=1.0):
         prompt = f"""
         Extract the movie title and release year from this text.
         Return in JSON format with keys 'movie' and 'year'. and give movie name space if it looks like two words.
         Text: "{text}"
         """
 
-        response = self.groq_client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-
-        response_content = response.choices[0].message.content
+        response_content = self._complete(prompt, deadline, fraction)
+        if response_content is None:
+            return None, None
 
         # Extract JSON string from the response content
         json_match = re.search(r'```json\s*(.*?)\s*```', response_content, re.DOTALL)
@@ -51,21 +110,42 @@ class MovieExtractor:
         else:
             return None, None
 
-    def get_movie_details(self, movie_name, year=None):
+    def get_movie_details(self, movie_name, year=None, deadline=None):
         """Get movie details from OMDb API"""
+        return self._omdb_lookup(movie_name, year, deadline)[0]
+
+    def _omdb_lookup(self, movie_name, year=None, deadline=None):
+        """
+        Returns (details, status); status is "ok", "not_found", or "skipped"
+        when the lookup did not run or did not complete.
+        """
         if not movie_name:
-            return None
+            return None, "not_found"
+        session, timeout = self.session, OMDB_TIMEOUT
+        if deadline is not None:
+            # Leave half the budget for the year-less retry when a year is given.
+            timeout = self._stage_timeout(deadline, 0.5 if year else 1.0, OMDB_TIMEOUT)
+            if timeout is None:
+                logging.warning("Deadline exhausted; skipping OMDb lookup for %s.", movie_name)
+                return None, "skipped"
+            session = self.single_shot_session
+        if not self.omdb_breaker.allow():
+            logging.warning("OMDb circuit open; skipping lookup for %s.", movie_name)
+            return None, "skipped"
         params = {"apikey": self.omdb_api_key, "t": movie_name}
         if year:
             params["y"] = year
+        recorded = False
         try:
-            response = self.session.get("https://www.omdbapi.com/", params=params, timeout=8)
+            response = session.get("https://www.omdbapi.com/", params=params, timeout=timeout)
             response.raise_for_status()
             data = response.json()
+            self.omdb_breaker.record_success()
+            recorded = True
             if data.get("Response") != "True":
                 if year:
-                    return self.get_movie_details(movie_name, None)
-                return None
+                    return self._omdb_lookup(movie_name, None, deadline)
+                return None, "not_found"
             return {
                 "Title": data.get("Title"),
                 "Year": data.get("Year"),
@@ -79,20 +159,33 @@ class MovieExtractor:
                 "imdbRating": data.get("imdbRating"),
                 "Poster": data.get("Poster"),
                 "LookupStatus": "ok"
-            }
+            }, "ok"
         except Exception as e:
+            if not recorded and _is_upstream_failure(e, timeout):
+                self.omdb_breaker.record_failure()
+                recorded = True
             logging.error("OMDb API error: %s", e)
-            return None
+            return None, "skipped"
+        finally:
+            if not recorded:
+                self.omdb_breaker.release()
 
-    def process(self, filename, caption):
-        """Main processing function."""
-        movie_name, year = self._llm_extract(filename + " " + caption)
+    def process(self, filename, caption, deadline=None):
+        """
+        Main processing function.
+        Returns partial details (title/year only, LookupStatus "partial") when the
+        OMDb lookup is skipped or fails after a title was extracted.
+        """
+        movie_name, year = self._llm_extract(filename + " " + caption, deadline, LLM_EXTRACT_SHARE)
         if not movie_name:
             logging.warning("Could not extract movie name from filename: %s", filename)
             return None
-        return self.get_movie_details(movie_name, year)
+        details, status = self._omdb_lookup(movie_name, year, deadline)
+        if status == "skipped":
+            return {"Title": movie_name, "Year": year, "LookupStatus": "partial"}
+        return details
 
-    def extract_movie_metadata(self, text):
+    def extract_movie_metadata(self, text, deadline=None):
         """
         Extracts movie metadata such as Size, Duration, Audio, Quality, HD, Subtitles, Video, Audio details.
         Returns a dictionary with these keys. If a value is not available, it is set to None.
@@ -115,13 +208,9 @@ class MovieExtractor:
         Text: "{text}"
         """
 
-        response = self.groq_client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-
-        response_content = response.choices[0].message.content
+        response_content = self._complete(prompt, deadline)
+        if response_content is None:
+            return {key: None for key in METADATA_KEYS}
 
         # Extract JSON string from the response content
         json_match = re.search(r'```json\s*(.*?)\s*```', response_content, re.DOTALL)
@@ -130,11 +219,62 @@ class MovieExtractor:
             try:
                 data = json.loads(json_string)
                 # Ensure all keys are present, set missing ones to None
-                keys = ["Size", "Duration", "Audio", "Quality", "HD", "Subtitles", "Video", "AudioDetails"]
-                metadata = {key: data.get(key) if data.get(key) is not None else None for key in keys}
+                metadata = {key: data.get(key) if data.get(key) is not None else None for key in METADATA_KEYS}
                 return metadata
             except json.JSONDecodeError:
-                return {key: None for key in ["Size", "Duration", "Audio", "Quality", "HD", "Subtitles", "Video", "AudioDetails"]}
+                return {key: None for key in METADATA_KEYS}
         else:
-            return {key: None for key in ["Size", "Duration", "Audio", "Quality", "HD", "Subtitles", "Video", "AudioDetails"]}
+            return {key: None for key in METADATA_KEYS}
+
+
+# Full names only, plus the few short forms that do not collide with ordinary title words.
+_LANGUAGES = {
+    "Tamil": ("Tamil", "Tam"),
+    "Telugu": ("Telugu", "Tel"),
+    "Hindi": ("Hindi", "Hin"),
+    "English": ("English", "Eng"),
+    "Malayalam": ("Malayalam",),
+    "Kannada": ("Kannada",),
+    "Bengali": ("Bengali",),
+    "Marathi": ("Marathi",),
+    "Korean": ("Korean",),
+    "Japanese": ("Japanese",),
+}
+_SIZE_RE = re.compile(r'\b(\d+(?:\.\d+)?)\s?(GB|MB)\b', re.IGNORECASE)
+_QUALITY_RE = re.compile(r'\b(2160p|1440p|1080p|720p|576p|480p|360p|4K)\b', re.IGNORECASE)
+_CODEC_RE = re.compile(r'\b(HEVC|x265|H\.?265|x264|H\.?264|AVC|10bit|AV1)\b', re.IGNORECASE)
+_CONTAINER_RE = re.compile(r'\b(MKV|MP4|AVI|WEBM)\b', re.IGNORECASE)
+_AUDIO_CODEC_RE = re.compile(r'(DD\+?\s?\d\.\d|DDP\s?\d\.\d|AAC|AC3|E-?AC-?3|DTS(?:-HD)?|TrueHD|Atmos|\d+\s?Kbps)', re.IGNORECASE)
+
 
+def rule_metadata(text):
+    """
+    Regex-only counterpart of MovieExtractor.extract_movie_metadata, with the same keys.
+    Used when the LLM path is unavailable or the sender is over their limit.
+    """
+    metadata = {key: None for key in METADATA_KEYS}
+    if not text:
+        return metadata
+    size = _SIZE_RE.search(text)
+    if size:
+        metadata["Size"] = f"{size.group(1)}{size.group(2).upper()}"
+    quality = _QUALITY_RE.search(text)
+    if quality:
+        q = quality.group(1).lower()
+        metadata["Quality"] = "4K" if q == "4k" else q
+        metadata["HD"] = "Yes" if q == "4k" or int(q[:-1]) >= 720 else "No"
+    video = [m.group(1) for m in _CODEC_RE.finditer(text)] + [m.group(1).upper() for m in _CONTAINER_RE.finditer(text)]
+    if video:
+        metadata["Video"] = " ".join(dict.fromkeys(video))
+    audio_details = [m.group(1) for m in _AUDIO_CODEC_RE.finditer(text)]
+    if audio_details:
+        metadata["AudioDetails"] = " & ".join(dict.fromkeys(audio_details))
+    languages = [
+        lang for lang, forms in _LANGUAGES.items()
+        if re.search(rf'\b({"|".join(forms)})\b', text, re.IGNORECASE)
+    ]
+    if languages:
+        metadata["Audio"] = ", ".join(languages)
+    if re.search(r'\bE-?Subs?\b', text, re.IGNORECASE):
+        metadata["Subtitles"] = "English"
+    return metadata
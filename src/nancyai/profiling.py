@@ -0,0 +1,141 @@
+import sys
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+
+MAX_PROFILE_SECONDS = 60
+SLOW_CALLBACK_SECONDS = 0.05  # callbacks holding the loop longer than this are recorded
+MAX_SLOW_CALLBACKS = 500
+MAX_TRACES = 200
+
+_slow_callbacks = deque(maxlen=MAX_SLOW_CALLBACKS)
+_traces = deque(maxlen=MAX_TRACES)
+_current_trace = contextvars.ContextVar("nancyai_trace", default=None)
+_profile_lock = threading.Lock()
+
+
+# --- Sampling profiler ---
+def _frame_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return ";".join(stack)
+
+
+def sample_stacks(seconds, interval=0.005):
+    """
+    Sample every thread's stack for `seconds` and return them in collapsed-stack
+    format ("frame;frame;frame count" per line), ready for flamegraph.pl or speedscope.
+    Blocking; run it in an executor. Only one profile runs at a time.
+    """
+    seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running.")
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts = Counter()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                counts[f"{thread_name};{_frame_stack(frame)}"] += 1
+            time.sleep(interval)
+        return "\n".join(f"{stack} {n}" for stack, n in counts.most_common()) + "\n"
+    finally:
+        _profile_lock.release()
+
+
+# --- Slow event-loop callbacks ---
+def _describe(handle):
+    # Task steps show up as opaque wrappers; name the coroutine they resume instead.
+    owner = getattr(handle._callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return f"Task {owner.get_name()} {getattr(coro, '__qualname__', coro)!s}"
+    return repr(handle)
+
+
+def install_slow_callback_monitor(threshold=SLOW_CALLBACK_SECONDS):
+    """
+    Time every event-loop callback and remember the ones that block the loop for
+    longer than `threshold`. Costs two perf_counter calls per callback.
+    """
+    handle_cls = asyncio.events.Handle
+    if getattr(handle_cls._run, "_nancyai_timed", False):
+        return
+    original_run = handle_cls._run
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            return original_run(self)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed >= threshold:
+                _slow_callbacks.append((elapsed, time.time(), _describe(self)))
+
+    _run._nancyai_timed = True
+    handle_cls._run = _run
+    logging.info("Slow callback monitor installed (threshold=%.0f ms).", threshold * 1000)
+
+
+def slowest_callbacks(limit=20):
+    return [
+        {"duration_ms": round(elapsed * 1000, 2), "at": at, "callback": callback}
+        for elapsed, at, callback in heapq.nlargest(limit, list(_slow_callbacks))
+    ]
+
+
+# --- Per-update trace spans ---
+@contextmanager
+def trace(name, **attrs):
+    """Collect the spans recorded while handling one update."""
+    record = {
+        "name": name,
+        **attrs,
+        "started_at": time.time(),
+        "spans": [],
+    }
+    start = time.perf_counter()
+    token = _current_trace.set((record, start))
+    try:
+        yield record
+    finally:
+        _current_trace.reset(token)
+        record["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        _traces.append(record)
+
+
+@contextmanager
+def span(name):
+    """Time a stage of the current update; a no-op outside of trace()."""
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    record, trace_start = current
+    start = time.perf_counter()
+    entry = {"name": name, "start_ms": round((start - trace_start) * 1000, 2)}
+    try:
+        yield
+    except BaseException as e:
+        entry["error"] = type(e).__name__
+        raise
+    finally:
+        entry["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        record["spans"].append(entry)
+
+
+def recent_traces(limit=50):
+    return list(_traces)[-max(1, limit):]
@@ -0,0 +1,40 @@
+import sqlite3
+
+from nancyai.dedup import SQLiteDedupCache, UpdateDedupCache
+
+
+def test_memory_cache_marks_all_keys():
+    cache = UpdateDedupCache()
+    assert not cache.check_and_mark("u:1", "m:1:1")
+    assert cache.check_and_mark("u:2", "m:1:1")
+    assert cache.check_and_mark("u:2")
+
+
+def test_sqlite_cache_survives_reopen(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    cache = SQLiteDedupCache(path)
+    assert not cache.check_and_mark("u:1")
+    cache.close()
+    cache = SQLiteDedupCache(path)
+    assert cache.check_and_mark("u:1")
+    cache.close()
+
+
+def test_sqlite_cache_lets_updates_through_after_close(tmp_path):
+    cache = SQLiteDedupCache(str(tmp_path / "dedup.db"))
+    cache.close()
+    assert not cache.check_and_mark("u:1")
+
+
+def test_sqlite_cache_lets_updates_through_on_error(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    cache = SQLiteDedupCache(path)
+    cache._conn.execute("PRAGMA busy_timeout=0")
+    locker = sqlite3.connect(path)
+    locker.execute("BEGIN EXCLUSIVE")
+    assert not cache.check_and_mark("u:1")
+    locker.rollback()
+    locker.close()
+    assert not cache.check_and_mark("u:1")
+    assert cache.check_and_mark("u:1")
+    cache.close()
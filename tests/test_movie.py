@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("groq")
+
+from nancyai.deadline import Deadline
+from nancyai.movie import MovieExtractor
+
+
+class FakeResponse:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"Response": "True", "Title": "Heat", "Year": "1995"}
+
+
+def _extractor(get):
+    extractor = MovieExtractor(groq_api_key="test", omdb_api_key="test")
+    extractor.single_shot_session.get = get
+    return extractor
+
+
+def _timeout(*args, **kwargs):
+    raise requests.Timeout("slow")
+
+
+def test_timeouts_within_deadline_open_breaker():
+    extractor = _extractor(_timeout)
+    for _ in range(extractor.omdb_breaker.failure_threshold):
+        assert extractor._omdb_lookup("Heat", None, Deadline(5)) == (None, "skipped")
+    assert not extractor.omdb_breaker.allow()
+
+
+def test_starved_timeouts_do_not_open_breaker():
+    extractor = _extractor(_timeout)
+    for _ in range(extractor.omdb_breaker.failure_threshold + 2):
+        extractor._omdb_lookup("Heat", None, Deadline(0.5))
+    assert extractor.omdb_breaker.allow()
+
+
+def test_breaker_recovers_after_reset_timeout():
+    calls = []
+
+    def get(*args, **kwargs):
+        calls.append(kwargs)
+        if len(calls) <= 3:
+            raise requests.Timeout("slow")
+        return FakeResponse()
+
+    extractor = _extractor(get)
+    extractor.omdb_breaker.reset_timeout = 0.01
+    for _ in range(3):
+        extractor._omdb_lookup("Heat", None, Deadline(5))
+    assert extractor._omdb_lookup("Heat", None, Deadline(5)) == (None, "skipped")
+    assert len(calls) == 3
+
+    time.sleep(0.02)
+    details, status = extractor._omdb_lookup("Heat", None, Deadline(5))
+    assert status == "ok" and details["Title"] == "Heat"
+    assert extractor.omdb_breaker.allow()
+
+
+def test_process_returns_partial_when_lookup_skipped():
+    extractor = _extractor(_timeout)
+    extractor._llm_extract = lambda text, deadline, fraction: ("Heat", "1995")
+    assert extractor.process("Heat.1995.mkv", "", Deadline(5)) == {
+        "Title": "Heat", "Year": "1995", "LookupStatus": "partial"
+    }